@@ -1,9 +1,15 @@
+import asyncio
 import logging
+import random
+import threading
+import time
 import requests
 import pandas as pd
 import streamlit as st
 import yfinance as yf
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # --- КОНФІГУРАЦІЯ СТОРІНКИ ---
@@ -105,6 +111,122 @@ def get_sentinel_macro_stable():
     except:
         return pd.DataFrame()
 
+# --- AI ПЛАНУВАЛЬНИК (Ранковий брифінг) ---
+# Активи, доступні для аналізу Price Action
+PA_ASSETS = ["XAUUSD", "XAGUSD", "XCUUSD", "EURUSD", "US100", "GER40", "DXY", "JP225"]
+
+def read_numeric_secret(key, default, cast, minimum):
+    # Некоректне значення в Secrets не повинно валити весь дашборд: повертаємось до значення за замовчуванням
+    raw_value = st.secrets.get(key, default)
+    try:
+        value = cast(raw_value)
+    except (TypeError, ValueError):
+        logging.warning(f"Некоректне значення {key}={raw_value!r} у Secrets, використовується {default}")
+        value = default
+    return max(minimum, value)
+
+# Ліміти Gemini можна перевизначити в Secrets без зміни коду.
+# За замовчуванням усі активи йдуть однією хвилею: сплеск bucket покриває весь брифінг,
+# а 10 RPM (free tier gemini-2.5-flash) визначають темп поповнення квоти між запусками.
+BRIEFING_MAX_CONCURRENCY = read_numeric_secret("BRIEFING_MAX_CONCURRENCY", len(PA_ASSETS), int, 1)
+BRIEFING_REQUESTS_PER_MINUTE = read_numeric_secret("BRIEFING_REQUESTS_PER_MINUTE", 10.0, float, 1.0)
+BRIEFING_BURST = read_numeric_secret("BRIEFING_BURST", len(PA_ASSETS), int, 1)
+BRIEFING_MAX_RETRIES = read_numeric_secret("BRIEFING_MAX_RETRIES", 3, int, 0)
+
+# Вікно квоти Gemini (RPM) та верхня межа однієї паузи між повторами
+QUOTA_WINDOW_SECONDS = 60.0
+MAX_RETRY_DELAY_SECONDS = 60.0
+
+# Помилки, після яких має сенс повторити запит (перевищення квоти, збої сервера)
+RETRYABLE_AI_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
+class TokenBucket:
+    """Token bucket: не більше `rate_per_minute` запитів із допустимим сплеском `capacity`."""
+
+    def __init__(self, rate_per_minute, capacity):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        # Bucket спільний для всіх сесій Streamlit (кожна у своєму потоці), тому стан захищено lock-ом
+        self.lock = threading.Lock()
+
+    async def acquire(self):
+        # Токен резервується одразу (баланс може піти в мінус), а очікування відбувається
+        # без блокування інших викликів: кожен чекає лише свою чергу в bucket
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            await asyncio.sleep(wait)
+
+@st.cache_resource
+def get_gemini_bucket():
+    # Один bucket на процес: квота Gemini спільна для всіх запусків і всіх сесій
+    return TokenBucket(BRIEFING_REQUESTS_PER_MINUTE, capacity=BRIEFING_BURST)
+
+def get_retry_delay(error):
+    # gRPC-помилка квоти може містити google.rpc.RetryInfo з рекомендованою паузою від API
+    for detail in getattr(error, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is None:
+            continue
+        if hasattr(retry_delay, "total_seconds"):
+            return retry_delay.total_seconds()
+        return retry_delay.seconds + retry_delay.nanos / 1e9
+    return None
+
+class AIRequestScheduler:
+    """Запуск запитів до Gemini з обмеженням конкурентності, спільним rate limit та backoff."""
+
+    def __init__(self, bucket, max_concurrency, max_retries, base_delay=2.0):
+        # Семафор прив'язується до event loop, тому планувальник створюється на кожен запуск,
+        # а bucket передається ззовні і зберігає стан квоти між запусками
+        self.semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        self.bucket = bucket
+        self.max_retries = max(0, max_retries)
+        self.base_delay = base_delay
+
+    def backoff_delay(self, error, attempt):
+        if isinstance(error, google_exceptions.ResourceExhausted):
+            api_delay = get_retry_delay(error)
+            if api_delay is not None:
+                return min(MAX_RETRY_DELAY_SECONDS, api_delay) + random.uniform(0, self.base_delay)
+            # Без підказки від API: крок не менший за інтервал одного токена, подвоєння на кожній спробі,
+            # щоб сумарне очікування перекрило щонайменше одне вікно квоти
+            token_interval = 1 / self.bucket.rate
+            delay = max(token_interval, self.base_delay) * 2 ** (attempt + 1)
+        else:
+            delay = self.base_delay * 2 ** attempt
+        # Jitter, щоб паралельні запити не повторювались синхронно
+        return min(MAX_RETRY_DELAY_SECONDS, delay) + random.uniform(0, self.base_delay)
+
+    async def generate(self, model, prompt, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            async with self.semaphore:
+                await self.bucket.acquire()
+                try:
+                    # Синхронний клієнт у робочому потоці: async-клієнт genai кешується глобально
+                    # і прив'язується до event loop, який asyncio.run закриває після кожного запуску
+                    response = await asyncio.to_thread(model.generate_content, prompt, **kwargs)
+                    return response.text
+                except RETRYABLE_AI_ERRORS as e:
+                    if attempt == self.max_retries:
+                        raise
+                    error = e
+            # Backoff поза семафором, щоб запит, що повторюється, не займав слот інших активів
+            delay = self.backoff_delay(error, attempt)
+            logging.warning(f"Gemini: повтор через {delay:.1f}s (спроба {attempt + 1}): {error}")
+            await asyncio.sleep(delay)
+
 # --- ГЛОБАЛЬНА БІЧНА ПАНЕЛЬ (Intelligence & Control Center) ---
 with st.sidebar:
     st.markdown("### 🕒 Час терміналу (Kyiv/EET)")
@@ -290,21 +412,19 @@ with tab2:
     render_tv()
     st.divider()
 
+    def format_price_action(df):
+        # Форматування для промпту
+        df = df[['Open', 'High', 'Low', 'Close']].dropna(how="all").round(2)
+        if df.empty:
+            return "Дані відсутні. Перевірте правильність тікера."
+        df.index = df.index.strftime('%Y-%m-%d')
+        return df.to_string()
+
     @st.cache_data(ttl=1800)
     def fetch_price_action(ticker_symbol):
         try:
             # Мапінг торгових інструментів MT5 на тікери Yahoo Finance (використовуємо ф'ючерси для металів)
-            yf_map = {
-                "XAUUSD": "GC=F",      # Ф'ючерс на золото (GC)
-                "XAGUSD": "SI=F",      # Ф'ючерс на срібло (SI)
-                "XCUUSD": "HG=F",      # Ф'ючерс на мідь (HG)
-                "EURUSD": "EURUSD=X",  # Спот EUR/USD
-                "US100": "NQ=F",       # Ф'ючерс Nasdaq 100
-                "GER40": "^GDAXI",     # Індекс DAX
-                "DXY": "DX-Y.NYB",     # Індекс Долара
-                "JP225": "^N225"       # Індекс Nikkei 225
-            }
-            actual_ticker = yf_map.get(ticker_symbol.upper(), ticker_symbol.upper())
+            actual_ticker = PRICE_TICKERS.get(ticker_symbol.upper(), ticker_symbol.upper())
             
             # Отримання свічкових даних за 14 днів
             stock = yf.Ticker(actual_ticker)
@@ -313,14 +433,126 @@ with tab2:
             if df.empty:
                 return "Дані відсутні. Перевірте правильність тікера."
             
-            # Форматування для промпту
-            df = df[['Open', 'High', 'Low', 'Close']].round(2)
-            df.index = df.index.strftime('%Y-%m-%d')
-            return df.to_string()
+            return format_price_action(df)
         except Exception as e:
             logging.error(f"Помилка yfinance: {e}")
             return "Помилка завантаження котирувань."
 
+    @st.cache_data(ttl=1800)
+    def fetch_price_action_batch(ticker_symbols):
+        # Один запит до Yahoo Finance для всіх активів брифінгу замість послідовних викликів.
+        # Помилки не перехоплюються тут, щоб st.cache_data не зберіг невдалий результат
+        ticker_map = {symbol: PRICE_TICKERS.get(symbol, symbol) for symbol in ticker_symbols}
+        data = yf.download(
+            list(ticker_map.values()),
+            period="14d",
+            group_by="ticker",
+            progress=False,
+            threads=True
+        )
+        if data.empty:
+            raise ValueError("Yahoo Finance повернув порожні дані")
+
+        result = {}
+        for symbol, actual_ticker in ticker_map.items():
+            try:
+                df = data[actual_ticker][['Open', 'High', 'Low', 'Close']].dropna(how="all")
+            except KeyError:
+                df = pd.DataFrame()
+            result[symbol] = None if df.empty else format_price_action(df)
+        return result
+
+    def load_briefing_ohlcv(ticker_symbols):
+        try:
+            ohlcv_by_asset = fetch_price_action_batch(ticker_symbols)
+        except Exception as e:
+            logging.error(f"Помилка yfinance (batch): {e}")
+            return {symbol: None for symbol in ticker_symbols}
+        if any(ohlcv_text is None for ohlcv_text in ohlcv_by_asset.values()):
+            # Частково невдале завантаження не повинно лишатись у кеші на 30 хвилин
+            fetch_price_action_batch.clear()
+        return ohlcv_by_asset
+
+    def build_pa_prompt(asset, ohlcv_text, user_query):
+        pa_prompt = f"""
+        Виконай детальний технічний аналіз Price Action для активу {asset} за останні 14 торгових днів.
+        
+        Дані OHLCV (Open, High, Low, Close):
+        {ohlcv_text}
+        
+        Обов'язкова структура звіту (розкрий кожен пункт розгорнуто, спираючись виключно на конкретні цифри з таблиці):
+        1. Домінуючий тренд: Опиши поточну структуру ринку (висхідна, низхідна, консолідація). Вкажи дати, де відбувся злам структури або підтвердження тренду.
+        2. Ключові рівні (POI / S&R): Визнач точні цінові зони підтримки та опору. Аргументуй їх формування конкретними максимумами (High) та мінімумами (Low) з наданих даних.
+        3. Ліквідність та патерни: Вкажи дні, де відбулося зняття ліквідності (пробій попередніх екстремумів з наступним поверненням ціни) або сформувалися явні розворотні формації.
+        """
+        
+        if user_query:
+            pa_prompt += f"\n\nСпецифічний запит трейдера: {user_query}\nІнтегруй детальну відповідь на цей запит у свій аналіз."
+        
+        pa_prompt += "\n\nФормат: Діловий, жорсткий, аналітичний. Заборонено використовувати загальні фрази. Використовуй марковані списки та жирний шрифт для виділення дат і цінових рівнів."
+        return pa_prompt
+
+    def build_pa_model():
+        return genai.GenerativeModel(
+            model_name="gemini-2.5-flash",
+            generation_config={
+                "temperature": 0.1, 
+                "max_output_tokens": 8192
+            }
+        )
+
+    # Відключення фільтрів безпеки для уникнення обривів при генерації фінансового аналізу
+    PA_SAFETY_SETTINGS = [
+        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+    ]
+
+    def show_briefing_result(panel, result):
+        level, text = result
+        getattr(panel, level)(text)
+
+    def render_briefing_panels(results):
+        panels = {}
+        for asset in PA_ASSETS:
+            with st.expander(f"📈 {asset}", expanded=True):
+                panels[asset] = st.empty()
+                show_briefing_result(panels[asset], results[asset])
+        return panels
+
+    async def run_morning_briefing(prompts, panels, results):
+        # Стандартний пул потоків на слабких хостах менший за кількість активів, тож розмір задаємо явно.
+        # asyncio.run закриває цей пул разом із loop після завершення брифінгу
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=BRIEFING_MAX_CONCURRENCY)
+        )
+        scheduler = AIRequestScheduler(
+            get_gemini_bucket(),
+            max_concurrency=BRIEFING_MAX_CONCURRENCY,
+            max_retries=BRIEFING_MAX_RETRIES
+        )
+        pa_model = build_pa_model()
+
+        async def analyze(asset):
+            try:
+                text = await scheduler.generate(pa_model, prompts[asset], safety_settings=PA_SAFETY_SETTINGS)
+                return asset, text, None
+            except Exception as e:
+                logging.error(f"Помилка брифінгу {asset}: {e}")
+                return asset, None, e
+
+        # Звіти виводяться в панелі в порядку завершення, а не в порядку запуску
+        for next_done in asyncio.as_completed([analyze(asset) for asset in prompts]):
+            asset, text, error = await next_done
+            if error is not None:
+                results[asset] = ("error", f"Помилка генерації звіту: {str(error)}")
+            elif text:
+                results[asset] = ("markdown", text)
+            else:
+                results[asset] = ("warning", "Отримано порожню відповідь від моделі.")
+            show_briefing_result(panels[asset], results[asset])
+
     @st.fragment
     def render_ai_chat():
         st.subheader("🤖 Sentinel Price Action (14D)")
@@ -329,60 +561,76 @@ with tab2:
         with asset_col:
             analyze_target = st.selectbox(
                 "Актив:", 
-                ["XAUUSD", "XAGUSD", "XCUUSD", "EURUSD", "US100", "GER40", "DXY", "JP225"], 
+                PA_ASSETS, 
                 index=0, 
                 key="asset_input"
             )
         with query_col:
-            user_query = st.text_input("Специфічний запит (залиш порожнім для загального звіту):", key="query_input")
+            user_query = st.text_input("Специфічний запит до обраного активу (залиш порожнім для загального звіту):", key="query_input")
         
-        if st.button("Провести аналіз Price Action", type="primary"):
+        btn_col, briefing_col = st.columns(2)
+        with btn_col:
+            run_single = st.button("Провести аналіз Price Action", type="primary", use_container_width=True)
+        with briefing_col:
+            run_briefing = st.button(
+                "☀️ Ранковий брифінг (всі активи)",
+                use_container_width=True,
+                help="Загальний звіт по кожному активу без специфічного запиту. "
+                     f"Ліміт: {BRIEFING_MAX_CONCURRENCY} паралельно, сплеск {BRIEFING_BURST}, "
+                     f"{BRIEFING_REQUESTS_PER_MINUTE:g} запитів/хв (спільно з одиночним аналізом). "
+                     "Повторний запуск протягом хвилини або тариф з нижчою квотою збільшують час брифінгу."
+            )
+
+        if run_single:
             with st.spinner(f'Завантаження даних {analyze_target} та генерація звіту...'):
                 ohlcv_text = fetch_price_action(analyze_target)
-                
-                pa_prompt = f"""
-                Виконай детальний технічний аналіз Price Action для активу {analyze_target} за останні 14 торгових днів.
-                
-                Дані OHLCV (Open, High, Low, Close):
-                {ohlcv_text}
-                
-                Обов'язкова структура звіту (розкрий кожен пункт розгорнуто, спираючись виключно на конкретні цифри з таблиці):
-                1. Домінуючий тренд: Опиши поточну структуру ринку (висхідна, низхідна, консолідація). Вкажи дати, де відбувся злам структури або підтвердження тренду.
-                2. Ключові рівні (POI / S&R): Визнач точні цінові зони підтримки та опору. Аргументуй їх формування конкретними максимумами (High) та мінімумами (Low) з наданих даних.
-                3. Ліквідність та патерни: Вкажи дні, де відбулося зняття ліквідності (пробій попередніх екстремумів з наступним поверненням ціни) або сформувалися явні розворотні формації.
-                """
-                
-                if user_query:
-                    pa_prompt += f"\n\nСпецифічний запит трейдера: {user_query}\nІнтегруй детальну відповідь на цей запит у свій аналіз."
-                
-                pa_prompt += "\n\nФормат: Діловий, жорсткий, аналітичний. Заборонено використовувати загальні фрази. Використовуй марковані списки та жирний шрифт для виділення дат і цінових рівнів."
+                pa_prompt = build_pa_prompt(analyze_target, ohlcv_text, user_query)
                 
                 try:
-                    pa_model = genai.GenerativeModel(
-                        model_name="gemini-2.5-flash",
-                        generation_config={
-                            "temperature": 0.1, 
-                            "max_output_tokens": 8192
-                        }
+                    # Одиночний звіт іде через той самий bucket, що й брифінг: квота Gemini спільна
+                    scheduler = AIRequestScheduler(
+                        get_gemini_bucket(),
+                        max_concurrency=1,
+                        max_retries=BRIEFING_MAX_RETRIES
+                    )
+                    pa_model = build_pa_model()
+                    response_text = asyncio.run(
+                        scheduler.generate(pa_model, pa_prompt, safety_settings=PA_SAFETY_SETTINGS)
                     )
                     
-                    # Відключення фільтрів безпеки для уникнення обривів при генерації фінансового аналізу
-                    safety_settings = [
-                        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                    ]
-                    
-                    response = pa_model.generate_content(pa_prompt, safety_settings=safety_settings)
-                    
-                    if response.text:
-                        st.markdown(response.text)
+                    if response_text:
+                        st.markdown(response_text)
                     else:
                         st.warning("Отримано порожню відповідь від моделі.")
                         
                 except Exception as e:
                     st.error(f"Помилка генерації звіту: {str(e)}")
+
+        if run_briefing:
+            with st.spinner("Завантаження котирувань для всіх активів..."):
+                ohlcv_by_asset = load_briefing_ohlcv(tuple(PA_ASSETS))
+
+            # Результати зберігаються в session_state, щоб пережити повторний запуск фрагмента.
+            # До завершення запиту в сховищі лежить статус "не завершено" на випадок переривання
+            results = {}
+            prompts = {}
+            for asset in PA_ASSETS:
+                if ohlcv_by_asset[asset] is None:
+                    results[asset] = ("warning", "Котирування недоступні — аналіз пропущено.")
+                else:
+                    prompts[asset] = build_pa_prompt(asset, ohlcv_by_asset[asset], user_query="")
+                    results[asset] = ("warning", "Аналіз не завершено — запустіть брифінг повторно.")
+            st.session_state["briefing_results"] = results
+
+            panels = render_briefing_panels(results)
+            for asset in prompts:
+                panels[asset].info("⏳ Аналіз у черзі...")
+
+            if prompts:
+                with st.spinner(f"Генерація брифінгу ({len(prompts)} активів, до {BRIEFING_MAX_CONCURRENCY} паралельно)..."):
+                    asyncio.run(run_morning_briefing(prompts, panels, results))
+        elif "briefing_results" in st.session_state:
+            render_briefing_panels(st.session_state["briefing_results"])
                     
     render_ai_chat()
     st.divider()